@@ -58,6 +58,21 @@ class GraphicsManager(object):
             self.surf.blit(self.textures[tex_name],
                            add_vecs(pos, offset), area=area)
 
+    def draw_batch(self, tex_name, parts, gridcoords=True,
+                   offset=(0, PANEL_H)):
+        """
+        Draw several areas of a texture with a single blits call.
+        :param parts: Sequence of (pos, area) tuples
+        """
+        if tex_name not in self.textures:
+            raise Exception('No such texture: {0}'.format(tex_name))
+        texture = self.textures[tex_name]
+        scale = CELL_SIZE if gridcoords else 1
+        off_x, off_y = offset
+        self.surf.blits([(texture,
+                          (pos[0] * scale + off_x, pos[1] * scale + off_y),
+                          area) for pos, area in parts], doreturn=False)
+
     def draw_string(self, pos, text, color, big=False):
         if big:
             font_surf = self.xolonium_font20.render(text, True, color)
@@ -4,6 +4,7 @@ import json
 from zipfile import ZipFile
 import os
 from heapq import nsmallest
+from functools import lru_cache
 
 from utils import (vec_lst_to_str, str_to_vec_lst, str_to_vec,
                    get_adjacent, m_distance, grid)
@@ -34,8 +35,12 @@ def wrap_around(pos):
     return pos
 
 
+@lru_cache(maxsize=COLS * ROWS)
 def on_edge(pos):
-    """Determines if pos is on the edge of the map."""
+    """
+    Determines if pos is on the edge of the map. The result only depends
+    on pos, so it is memoized for every tile of the map.
+    """
     return (pos[0] == 0 or pos[0] == COLS-1 or
             pos[1] == 0 or pos[1] == ROWS-1)
 
@@ -109,6 +114,7 @@ class TileMapBase(object):
         self.textures = {int(tid): tex for (tid, tex) in list(self.textures.items())}
         self.spawnpoints = [tuple(sp) for sp in config.get('spawnpoints', [])]
         self.portals = {}
+        self._portal_neighbor_cache = None
         self.tiles = [0] * COLS
         self.tiles = [[0] * ROWS for _ in self.tiles]
         self.blocked = set(str_to_vec_lst(blocked_raw))
@@ -161,6 +167,23 @@ class TileMapBase(object):
         """
         self.portals[p1] = (p2, p1_dir)
         self.portals[p2] = (p1, p2_dir)
+        self._portal_neighbor_cache = None
+
+    @property
+    def portal_neighbors(self):
+        """
+        Map every tile right next to a portal to that portal. Built lazily
+        and rebuilt after portals have been added.
+        :return: dict
+        """
+        if self._portal_neighbor_cache is None:
+            self._portal_neighbor_cache = {}
+            for portal in self.portals:
+                pos_x, pos_y = portal
+                for adjacent in ((pos_x+1, pos_y), (pos_x-1, pos_y),
+                                 (pos_x, pos_y+1), (pos_x, pos_y-1)):
+                    self._portal_neighbor_cache.setdefault(adjacent, portal)
+        return self._portal_neighbor_cache
 
     def is_unblocked(self, pos):
         """
@@ -3,6 +3,7 @@
 import pygame
 
 from collections import defaultdict
+from itertools import islice
 
 from powerup import PowerupManager
 from core.map import TileMap
@@ -121,7 +122,7 @@ class GameModeBase(object):
         for player in self.players:
             self.spatialhash[player.snake[0]].append((
                 player.snake.head_tag, player.snake))
-            for snake in player.snake[1:]:
+            for snake in islice(player.snake.body, 1, None):
                 self.spatialhash[snake].append((player.snake.body_tag,
                                                 player.snake))
 
@@ -3,13 +3,16 @@
 Snake module.
 """
 
-from pygame import Rect
+from abc import abstractmethod
+from collections import deque
+from itertools import islice
 
 from constants import (MAX_HITPOINTS,
                        INIT_SPEED, MIN_SPEED, MAX_SPEED)
 from constants import INVINCIBILITY_BLINK_RATE
-from utils import add_vecs, sub_vecs, normalize, m_distance
+from utils import sub_vecs, normalize, m_distance
 from core.map import wrap_around, on_edge
+from fsm import State
 
 # -- Directions --
 EAST = (+1, 0)
@@ -17,11 +20,13 @@ WEST = (-1, 0)
 NORTH = (0, -1)
 SOUTH = (0, +1)
 DIRECTIONS = {'E': EAST, 'W': WEST, 'N': NORTH, 'S': SOUTH}
+# Headings which are already normalized
+CANONICAL_HEADINGS = frozenset(DIRECTIONS.values()) | {(0, 0)}
 
-STRAIGHT1_V = Rect(20, 20, 10, 10)
-STRAIGHT1_H = Rect(20, 30, 10, 10)
-STRAIGHT2_V = Rect(30, 20, 10, 10)
-STRAIGHT2_H = Rect(30, 30, 10, 10)
+STRAIGHT1_V = (20, 20, 10, 10)
+STRAIGHT1_H = (20, 30, 10, 10)
+STRAIGHT2_V = (30, 20, 10, 10)
+STRAIGHT2_H = (30, 30, 10, 10)
 
 N = 0x1
 E = 0x2
@@ -38,116 +43,145 @@ VERTICAL = 0x20
 # Maps vectors to their corresponding direction flags.
 VEC_TO_DIRFLAG = {(0, -1): N, (1, 0): E, (0, 1): S, (-1, 0): W}
 
-HEAD = {N: Rect(00, 00, 10, 10), S: Rect(10, 10, 10, 10),
-        E: Rect(10, 00, 10, 10), W: Rect(00, 10, 10, 10)}
+# Same mapping as a flat table indexed by ((x + 1) << 2) | (y + 1), which
+# avoids hashing the vector.
+DIRFLAG_LUT = bytearray(VEC_TO_DIRFLAG.get(((i >> 2) - 1, (i & 3) - 1), 0)
+                        for i in range(16))
 
-TAIL = {N: Rect(20, 00, 10, 10), S: Rect(30, 10, 10, 10),
-        E: Rect(30, 00, 10, 10), W: Rect(20, 10, 10, 10)}
+# Skin areas, indexed by direction flag.
+HEAD = [None] * 16
+HEAD[N] = (00, 00, 10, 10)
+HEAD[S] = (10, 10, 10, 10)
+HEAD[E] = (10, 00, 10, 10)
+HEAD[W] = (00, 10, 10, 10)
 
-TURN = {SE: Rect(00, 20, 10, 10), SW: Rect(10, 20, 10, 10),
-        NE: Rect(00, 30, 10, 10), NW: Rect(10, 30, 10, 10)}
+TAIL = [None] * 16
+TAIL[N] = (20, 00, 10, 10)
+TAIL[S] = (30, 10, 10, 10)
+TAIL[E] = (30, 00, 10, 10)
+TAIL[W] = (20, 10, 10, 10)
+
+TURN = [None] * 16
+TURN[SE] = (00, 20, 10, 10)
+TURN[SW] = (10, 20, 10, 10)
+TURN[NE] = (00, 30, 10, 10)
+TURN[NW] = (10, 30, 10, 10)
 
 
 def get_next_to_portal(pos, tilemap):
     """Determine whether pos is right next to a portal.
     :return: The portal next to pos or None
     """
-    for portal in list(tilemap.portals.keys()):
-        if m_distance(portal, pos) == 1:
-            return portal
-
-    return None
+    return tilemap.portal_neighbors.get(pos)
 
 
-def get_arrangement(snake, index, tilemap):
+def _get_arrangement(vec_a, vec_b, vec_c, portal):
     """
     Get the arrangement of a snake part in relation to it's neighboring
     parts while taking the map and it's portals into account as well.
     This is to determine which part of the skin texture to use for
     rendering said part.
+    :param vec_a: The previous part (towards the head)
+    :param vec_b: The part itself
+    :param vec_c: The next part (towards the tail)
+    :param portal: The portal next to vec_b or None
     """
-    vec_ax, vec_ay = vec_a = snake[index - 1]
-    vec_bx, vec_by = vec_b = snake[index]
-    vec_cx, vec_cy = vec_c = snake[index + 1]
-
-    vec_ba = sub_vecs(vec_a, vec_b)
-    vec_bc = sub_vecs(vec_c, vec_b)
-
-    ba_apart = m_distance(vec_a, vec_b) > 1
-    bc_apart = m_distance(vec_c, vec_b) > 1
+    vec_ax, vec_ay = vec_a
+    vec_bx, vec_by = vec_b
+    vec_cx, vec_cy = vec_c
 
-    a_on_edge = on_edge(vec_a)
+    ba_x, ba_y = vec_ax - vec_bx, vec_ay - vec_by
+    bc_x, bc_y = vec_cx - vec_bx, vec_cy - vec_by
 
-    if ba_apart:
-        if a_on_edge:
-            vec_ba = normalize(vec_ba)
+    ba_apart = abs(ba_x) + abs(ba_y) > 1
+    bc_apart = abs(bc_x) + abs(bc_y) > 1
 
-        portal = get_next_to_portal(vec_b, tilemap)
-        if portal:
-            vec_a = portal
-            vec_ax, vec_ay = vec_a
-            vec_ba = sub_vecs(vec_a, vec_b)
+    if ba_apart or bc_apart:
+        a_on_edge = on_edge(vec_a)
 
-    if bc_apart:
-        if a_on_edge:
-            vec_bc = normalize((-vec_bc[0], -vec_bc[1]))
+        if ba_apart:
+            if portal:
+                vec_ax, vec_ay = portal
+                ba_x, ba_y = vec_ax - vec_bx, vec_ay - vec_by
+            elif a_on_edge:
+                ba_x, ba_y = normalize((ba_x, ba_y))
 
-        portal = get_next_to_portal(vec_b, tilemap)
-
-        if portal:
-            vec_c = portal
-            vec_cx, vec_cy = vec_c
-            vec_bc = sub_vecs(vec_c, vec_b)
+        if bc_apart:
+            if portal:
+                vec_cx, vec_cy = portal
+                bc_x, bc_y = vec_cx - vec_bx, vec_cy - vec_by
+            elif a_on_edge:
+                bc_x, bc_y = normalize((-bc_x, -bc_y))
 
     if vec_ax == vec_bx == vec_cx:
         return VERTICAL | STRAIGHT
     elif vec_ay == vec_by == vec_cy:
         return STRAIGHT
-    else:
-        return VEC_TO_DIRFLAG[vec_ba] | VEC_TO_DIRFLAG[vec_bc]
+
+    return ((N if ba_y < 0 else S if ba_y > 0 else 0) |
+            (E if ba_x > 0 else W if ba_x < 0 else 0) |
+            (N if bc_y < 0 else S if bc_y > 0 else 0) |
+            (E if bc_x > 0 else W if bc_x < 0 else 0))
 
 
-class SnakeNormalState(object):
+class SnakeState(State):
 
     """
-    The state, the snake is normally in.
+    Base class for Snake States.
     """
 
     def __init__(self, snake):
         self.snake = snake
 
+    @abstractmethod
+    def update(self, delta_time):
+        pass
+
+
+class SnakeNormalState(SnakeState):
+
+    """
+    The state, the snake is normally in.
+    """
+
     def update(self, delta_time):
         """Update state."""
         self.snake.move()
 
 
-class SnakeInvincibleState(object):
+class SnakeInvincibleState(SnakeState):
 
     """
     The state, the snake is in when it's invincible.
     """
 
-    def __init__(self, snake, lifetime):
-        self.snake = snake
-        self.snake.isinvincible = True
+    def __init__(self, snake, lifetime=0.):
+        SnakeState.__init__(self, snake)
+        self.reset(lifetime)
+
+    def reset(self, lifetime):
+        """Restart the state with a new lifetime."""
         self.lifetime = lifetime
-        self.elapsed_lifetime = 0.
-        self.elapsed_blink = 0.
+        self.elapsed_t = 0.
+        self.blink_deadline = INVINCIBILITY_BLINK_RATE
 
     def update(self, delta_time):
         """Update state."""
-        self.elapsed_lifetime += delta_time
-        self.elapsed_blink += delta_time
+        self.elapsed_t += delta_time
 
-        if self.elapsed_blink >= INVINCIBILITY_BLINK_RATE:
-            self.elapsed_blink -= INVINCIBILITY_BLINK_RATE
+        if self.elapsed_t >= self.blink_deadline:
+            self.blink_deadline += INVINCIBILITY_BLINK_RATE
             self.snake.isvisible = not self.snake.isvisible
 
-        if self.elapsed_lifetime >= self.lifetime:
-            self.snake.change_state(SnakeNormalState(self.snake))
+        if self.elapsed_t >= self.lifetime:
+            self.snake.change_state(self.snake._normal_state)
 
         self.snake.move()
 
+    def enter(self):
+        """Enter state."""
+        self.snake.isinvincible = True
+
     def leave(self):
         """Leave state."""
         self.snake.isinvincible = False
@@ -165,21 +199,29 @@ class Snake(object):
         self.body_tag = '#p{0}-body'.format(_id)
         self.head_tag = '#p{0}-head'.format(_id)
         self.skin = skin
-        self.body = [pos, (pos[0] + 1, pos[1])]
+        self.body = deque([pos, (pos[0] + 1, pos[1])])
         self.heading = None
         self._hitpoints = config.get('hp', MAX_HITPOINTS)
         self._speed = config.get('speed', INIT_SPEED)
         self._speed_bonus = 0
+        self._recompute_period()
         self.elapsed_t = 0.
         self.grow = 0
         self.isalive = True
         self.isvisible = True
         self.isinvincible = False
         self.ismoving = False
-        self.curr_state = SnakeInvincibleState(self, 5)
+        self._normal_state = SnakeNormalState(self)
+        self._invincible_state = SnakeInvincibleState(self)
+        self.curr_state = self._normal_state
         self.killed_event = killed_handler
-        self.prev = self.body[:]
+        self._prev_head_added = None
+        self._prev_tails_removed = []
         self.prev_heading = self.heading
+        self._tail_area_cache = None
+        self._arrangement_cache = []
+        self._arrangement_dirty = True
+        self._become_invincible(5)
 
     @property
     def hitpoints(self):
@@ -204,12 +246,8 @@ class Snake(object):
     @speed.setter
     def speed(self, value):
         """Set speed."""
-        if value > MAX_SPEED:
-            self._speed = MAX_SPEED
-        elif value < MIN_SPEED:
-            self._speed = MIN_SPEED
-        else:
-            self._speed = value
+        self._speed = min(MAX_SPEED, max(MIN_SPEED, value))
+        self._recompute_period()
 
     @property
     def speed_bonus(self):
@@ -220,6 +258,27 @@ class Snake(object):
     def speed_bonus(self, value):
         """Set speed bonus."""
         self._speed_bonus = value
+        self._recompute_period()
+
+    def _recompute_period(self):
+        """Update the time it takes to advance by one tile."""
+        self._period = 1. / (self._speed + self._speed_bonus)
+
+    @property
+    def heading(self):
+        """Return heading."""
+        return self._heading
+
+    @heading.setter
+    def heading(self, value):
+        """Set heading and the matching part of the skin for the head."""
+        self._heading = value
+        if value and value != (0, 0):
+            head_x, head_y = value
+            self._head_area = HEAD[DIRFLAG_LUT[((head_x + 1) << 2) |
+                                               (head_y + 1)]]
+        else:
+            self._head_area = HEAD[W]
 
     def gain_speed(self, speed):
         """Increase (or decrease) speed."""
@@ -234,63 +293,88 @@ class Snake(object):
     def set_heading(self, new_heading):
         """Set heading."""
         self.prev_heading = self.heading
-        self.heading = (normalize(new_heading) if new_heading != (0, 0)
-                        else new_heading)
+        self.heading = (new_heading if new_heading in CANONICAL_HEADINGS
+                        else normalize(new_heading))
+        # Segment arrangements don't depend on the heading and the tail
+        # only on whether there is one at all
+        if ((self.prev_heading in (None, (0, 0))) !=
+                (self.heading in (None, (0, 0)))):
+            self._tail_area_cache = None
+
+    def _invalidate_draw_cache(self):
+        """Discard cached skin areas after the body changed."""
+        self._tail_area_cache = None
+        self._arrangement_dirty = True
 
     def change_state(self, new_state):
         """Transit to another state."""
-        if hasattr(self.curr_state, 'leave'):
-            self.curr_state.leave()
+        self.curr_state.leave()
         self.curr_state = new_state
+        self.curr_state.enter()
+
+    def _become_invincible(self, lifetime):
+        """Transit to the (reused) invincible state."""
+        self._invincible_state.reset(lifetime)
+        self.change_state(self._invincible_state)
 
     def take_damage(self, dmg, dealt_by, setback=False,
                     invincible=False, invinc_lifetime=0, shrink=0, slowdown=0):
         """Take damage."""
+        if setback:
+            # Set the snake back to its previous position
+            self._restore_prev()
+            head_x, head_y = self.body[0]
+            neck_x, neck_y = self.body[1]
+            # Sign of the difference, i.e. -1, 0 or 1
+            xpos = (head_x > neck_x) - (head_x < neck_x)
+            ypos = (head_y > neck_y) - (head_y < neck_y)
+            self.set_heading((xpos, ypos))
+            self.prev_heading = (xpos, ypos)
+
         if not self.isinvincible:
             self.hitpoints -= dmg
             for _ in range(shrink):
                 if len(self.body) == 2:
                     break
-                if setback:
-                    self.prev.pop()
-                else:
-                    self.body.pop()
+                tail = self.body.pop()
+                if not setback:
+                    # A later setback restores parts lost since the last
+                    # advance
+                    self._prev_tails_removed.append(tail)
             self.gain_speed(-slowdown)
-
-        if setback:
-            # Set the snake back to its previous position
-            self.body = self.prev[:]
-            xpos = 0
-            ypos = 0
-            if self.body[0][0] > self.body[1][0]:
-                xpos = 1
-            elif self.body[0][0] < self.body[1][0]:
-                xpos = -1
-            if self.body[0][1] > self.body[1][1]:
-                ypos = 1
-            elif self.body[0][1] < self.body[1][1]:
-                ypos = -1
-            self.set_heading((xpos, ypos))
-            self.prev_heading = (xpos, ypos)
+            self._invalidate_draw_cache()
 
         if invincible and not self.isinvincible:
-            self.change_state(SnakeInvincibleState(self, invinc_lifetime))
+            self._become_invincible(invinc_lifetime)
 
         if self.hitpoints <= 0:
             self.isalive = False
             self.killed_event(dealt_by)
 
+    def _restore_prev(self):
+        """Undo the changes to the body since the last advance."""
+        if self._prev_head_added is not None:
+            self.body.popleft()
+        self.body.extend(reversed(self._prev_tails_removed))
+        self._prev_head_added = None
+        self._prev_tails_removed = []
+        self._invalidate_draw_cache()
+
     def respawn(self, pos):
         """Respawn snake."""
-        self.body = [pos, (pos[0] + 1, pos[1])]
+        self.body = deque([pos, (pos[0] + 1, pos[1])])
+        self._prev_head_added = None
+        self._prev_tails_removed = []
         self._speed = INIT_SPEED
+        self._recompute_period()
         self.heading = None
         self.prev_heading = None
         self.ismoving = False
         self.isalive = True
         self.hitpoints = MAX_HITPOINTS
-        self.change_state(SnakeInvincibleState(self, 3.5))
+        self._become_invincible(3.5)
         self.elapsed_t = 0
+        self._invalidate_draw_cache()
 
     def update(self, delta_time):
         """Update snake."""
@@ -307,23 +391,70 @@ class Snake(object):
         if not self.ismoving:
             return
 
-        self.body[0] = wrap_around(self.body[0])
+        body = self.body
+        head = wrap_around(body[0])
+        if head != body[0]:
+            body[0] = head
+            self._invalidate_draw_cache()
         # Move Snake
-        if self.elapsed_t >= 1. / (self._speed + self._speed_bonus):
-            self.prev = self.body[:]
-            self.elapsed_t -= 1. / (self._speed + self._speed_bonus)
-            self.body.insert(0, add_vecs(self.body[0], self.heading))
+        period = self._period
+        if self.elapsed_t >= period:
+            self._tail_area_cache = None
+            self.elapsed_t -= period
+            # Remember what changed so take_damage can set the snake back.
+            # Wrap the new head right away so it never sits outside of the
+            # map, e.g. drawn over the panel.
+            self._prev_head_added = wrap_around((head[0] + self.heading[0],
+                                                 head[1] + self.heading[1]))
+            self._prev_tails_removed = []
+            body.appendleft(self._prev_head_added)
             if self.grow == 0:
-                self.body.pop()
+                self._prev_tails_removed.append(body.pop())
             elif self.grow > 0:
                 self.grow -= 1
             elif self.grow < 0:
                 for _ in range(-self.grow+1):
-                    if len(self.body) == 2:
+                    if len(body) == 2:
                         break
-                    self.body.pop()
+                    self._prev_tails_removed.append(body.pop())
                 self.grow = 0
 
+            if not self._arrangement_dirty:
+                self._shift_arrangements()
+
+    def _shift_arrangements(self):
+        """
+        Update the arrangement cache after the body advanced. Only the
+        new neck needs computing, all other parts kept their neighbors.
+        """
+        body = self.body
+        if len(body) > 2:
+            tilemap = self.game.current_state.mode.tilemap
+            self._arrangement_cache.insert(0, _get_arrangement(
+                body[0], body[1], body[2],
+                get_next_to_portal(body[1], tilemap)))
+        # The new tail and any removed parts have no arrangement
+        del self._arrangement_cache[len(body) - 2:]
+
+    def _get_tail_area(self, tilemap):
+        """Determine which part of the skin to use for the tail."""
+        if not self.heading or self.heading == (0, 0):
+            return TAIL[W]
+
+        tail = self.body[-1]
+        second_last = self.body[-2]
+        apart = m_distance(tail, second_last) > 1
+
+        if apart:
+            portal = get_next_to_portal(tail, tilemap)
+
+            if portal:
+                second_last = portal
+
+        vec_x, vec_y = normalize(sub_vecs(second_last, tail))
+
+        return TAIL[DIRFLAG_LUT[((vec_x + 1) << 2) | (vec_y + 1)]]
+
     def draw(self):
         """Draw snake."""
         if not self.isalive or not self.isvisible:
@@ -331,17 +462,26 @@ class Snake(object):
 
         body_len = len(self.body)
         area = None
+        parts = []
         tilemap = self.game.current_state.mode.tilemap
 
+        if self._arrangement_dirty:
+            # Walk all (previous, current, next) triples in a single pass
+            # instead of indexing into the deque
+            self._arrangement_cache = [
+                _get_arrangement(vec_a, vec_b, vec_c,
+                                 get_next_to_portal(vec_b, tilemap))
+                for vec_a, vec_b, vec_c in zip(self.body,
+                                               islice(self.body, 1, None),
+                                               islice(self.body, 2, None))]
+            self._arrangement_dirty = False
+
         for index, part in enumerate(self.body):
             if index == 0:
-                if self.heading and self.heading != (0, 0):
-                    area = HEAD[VEC_TO_DIRFLAG[self.heading]]
-                else:
-                    area = HEAD[W]
+                area = self._head_area
 
             elif 0 < index < (body_len - 1):
-                argm = get_arrangement(self.body, index, tilemap)
+                argm = self._arrangement_cache[index - 1]
 
                 if argm & STRAIGHT == STRAIGHT:
                     if argm & VERTICAL == VERTICAL:
@@ -357,27 +497,18 @@ class Snake(object):
                 else:
                     area = TURN[argm & 15]
             else:
-                if self.heading and self.heading != (0, 0):
-                    tail = self.body[body_len-1]
-                    second_last = self.body[body_len-2]
-                    apart = m_distance(tail, second_last) > 1
+                if self._tail_area_cache is None:
+                    self._tail_area_cache = self._get_tail_area(tilemap)
 
-                    if apart:
-                        portal = get_next_to_portal(tail, tilemap)
+                area = self._tail_area_cache
 
-                        if portal:
-                            second_last = portal
-
-                    vec = sub_vecs(second_last, tail)
-
-                    area = TAIL[VEC_TO_DIRFLAG[normalize(vec)]]
-                else:
-                    area = TAIL[W]
+            parts.append((part, area))
 
-            self.game.graphics.draw(self.skin, part, area=area)
+        self.game.graphics.draw_batch(self.skin, parts)
 
     def __setitem__(self, i, item):
         self.body[i] = item
+        self._invalidate_draw_cache()
 
     def __getitem__(self, i):
         return self.body[i]
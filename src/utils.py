@@ -2,6 +2,7 @@
 """Contains useful functions/classes"""
 
 from math import hypot
+from functools import lru_cache
 
 
 def grid(cols, rows):
@@ -48,9 +49,11 @@ def distance(vec1, vec2):
     return hypot(vec1[0] - vec2[0], vec1[1] - vec2[1])
 
 
+@lru_cache(maxsize=256)
 def normalize(vec):
     """
     Normalize vector. Note that this functions returns an int vector.
+    Results are memoized, so vec has to be a tuple.
     """
     length = hypot(vec[0], vec[1])
     return int(round(vec[0] / length)), int(round(vec[1] / length))